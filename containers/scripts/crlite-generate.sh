@@ -37,7 +37,8 @@ echo "crlite-fullrun: disk usage"
 du -hc ${ID}
 
 ${workflow}/1-generate_mlbf ${ID} \
-              --filter-bucket ${crlite_filter_bucket:-crlite_filters_staging}
+              --filter-bucket ${crlite_filter_bucket:-crlite_filters_staging} \
+              --workers ${crlite_generate_workers:-1}
 
 if [ "x${DoNotUpload}x" == "xx" ] ; then
   ${workflow}/2-upload_artifacts_to_storage ${ID} \
@@ -11,9 +11,12 @@ import logging
 import moz_crlite_lib as crlite
 import os
 import psutil
+import shutil
 import statsd
 import sys
+import tempfile
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from filtercascade import FilterCascade, fileformats
 from pathlib import Path
 
@@ -55,8 +58,16 @@ metrics = statsd.StatsClient(
 )
 
 
-def initIssuerStats(stats, issuer):
-    stats["Issuers"][issuer] = {
+# Per-issuer stats travel from the workers, and are collected by
+# createCertLists, as columns in this order.
+issuerStatsFields = ("known", "revoked", "knownnotrevoked", "knownrevoked", "crl")
+
+
+def processIssuer(issuerObj, scratch_dir):
+    # Runs in a worker process: load and diff a single issuer and write its
+    # cert list records to files in scratch_dir, handing back only the stats
+    # and the paths for the parent to append to the keys files.
+    issuer_stats = {
         "known": 0,
         "revoked": 0,
         "knownnotrevoked": 0,
@@ -64,6 +75,85 @@ def initIssuerStats(stats, issuer):
         "crl": False,
     }
 
+    sets = issuerObj.load_and_make_sets(issuer_stats)
+
+    issuer_stats["knownnotrevoked"] = len(sets["knownNotRevoked"])
+    issuer_stats["knownrevoked"] = len(sets["knownRevoked"])
+
+    revoked_path = Path(scratch_dir) / f"{issuerObj.issuer}.revoked"
+    with open(revoked_path, "wb", buffering=crlite.file_buffer_size) as revfile:
+        crlite.writeSerialListForIssuer(
+            file=revfile, issuer_base64=issuerObj.issuer, serials=sets["knownRevoked"]
+        )
+    nonrevoked_path = Path(scratch_dir) / f"{issuerObj.issuer}.valid"
+    with open(nonrevoked_path, "wb", buffering=crlite.file_buffer_size) as nonrevfile:
+        crlite.writeSerialListForIssuer(
+            file=nonrevfile,
+            issuer_base64=issuerObj.issuer,
+            serials=sets["knownNotRevoked"],
+        )
+
+    return {
+        "issuer": issuerObj.issuer,
+        "stats": tuple(issuer_stats[field] for field in issuerStatsFields),
+        "knownRevokedPath": revoked_path,
+        "knownNotRevokedPath": nonrevoked_path,
+    }
+
+
+def genProcessedIssuers(executor, issuerObjs, scratch_dir, *, workers):
+    # Yields processIssuer results in the order of issuerObjs, so the output
+    # files stay sorted by issuer as find_additions expects.
+    #
+    # Issuer sizes span several orders of magnitude, so hand the workers the
+    # largest issuers first to keep one of them from being the tail. Left
+    # alone, that would load the `workers` largest issuers' sets at once.
+    # Instead, the known files of the issuers in flight may add up to at
+    # most the largest one, which is what the single-process loop peaked at:
+    # the biggest issuers run on their own and the small ones share the
+    # pool.
+    bySize = sorted(issuerObjs, key=lambda i: i.knownSize)
+    budget = bySize[-1].knownSize if bySize else 0
+    inFlight = {}
+    finished = {}
+
+    try:
+        for issuerObj in issuerObjs:
+            while issuerObj.issuer not in finished:
+                inFlightSize = sum(i.knownSize for i in inFlight.values())
+                while (
+                    bySize
+                    and len(inFlight) < workers
+                    and (not inFlight or inFlightSize + bySize[-1].knownSize <= budget)
+                ):
+                    nextObj = bySize.pop()
+                    future = executor.submit(processIssuer, nextObj, scratch_dir)
+                    inFlight[future] = nextObj
+                    inFlightSize += nextObj.knownSize
+
+                done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # Fail on the first broken issuer, not when its turn comes
+                    if future.exception() is not None:
+                        raise future.exception()
+                    finished[inFlight.pop(future).issuer] = future.result()
+
+            # Results that finish ahead of their turn only hold stats and
+            # scratch file paths, so waiting on a small issuer doesn't pile the
+            # serial lists up in memory.
+            yield finished.pop(issuerObj.issuer)
+    finally:
+        # Leaving the executor waits for every queued issuer, so cancel them
+        # to fail as soon as one issuer does.
+        for future in inFlight:
+            future.cancel()
+
+
+def appendAndRemove(file, path):
+    with open(path, "rb") as part:
+        shutil.copyfileobj(part, file, crlite.file_buffer_size)
+    os.remove(path)
+
 
 @metrics.timer("CreateCertLists")
 def createCertLists(
@@ -74,13 +164,10 @@ def createCertLists(
     known_nonrevoked_path,
     exclude_issuer,
     stats,
+    workers=1,
 ):
-    stats["knownrevoked"] = 0
-    stats["knownnotrevoked"] = 0
-    stats["revoked"] = 0
-    stats["known"] = 0
-    stats["nocrl"] = 0
-    stats["Issuers"] = {}
+    issuers = []
+    issuerColumns = {field: [] for field in issuerStatsFields}
 
     log.info(
         f"Generating revoked/nonrevoked lists {known_revoked_path} {known_nonrevoked_path} "
@@ -90,15 +177,23 @@ def createCertLists(
     os.makedirs(os.path.dirname(known_revoked_path), exist_ok=True)
     os.makedirs(os.path.dirname(known_nonrevoked_path), exist_ok=True)
 
-    with open(known_revoked_path, "wb") as revfile, open(
-        known_nonrevoked_path, "wb"
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(known_nonrevoked_path)
+    ) as scratch_dir, ProcessPoolExecutor(max_workers=workers) as executor, open(
+        known_revoked_path, "wb", buffering=crlite.file_buffer_size
+    ) as revfile, open(
+        known_nonrevoked_path, "wb", buffering=crlite.file_buffer_size
     ) as nonrevfile:
         issuerPathIter = crlite.genIssuerPathObjects(
             knownPath=known_path, revokedPath=revoked_path, excludeIssuer=exclude_issuer
         )
-        for issuerObj in sorted(issuerPathIter, key=lambda i: i.issuer):
+        issuerObjs = sorted(issuerPathIter, key=lambda i: i.issuer)
+
+        for result in genProcessedIssuers(
+            executor, issuerObjs, scratch_dir, workers=workers
+        ):
             log.debug(
-                f"createCertLists Processing issuerObj={issuerObj}, "
+                f"createCertLists Processed issuer={result['issuer']}, "
                 + f"memory={psutil.virtual_memory()}"
             )
             metrics.gauge(
@@ -106,30 +201,19 @@ def createCertLists(
                 psutil.virtual_memory().available,
             )
 
-            issuer = issuerObj.issuer
-            initIssuerStats(stats, issuer)
-
-            sets = issuerObj.load_and_make_sets(stats)
-
-            known_nonrevoked_certs_len = len(sets["knownNotRevoked"])
-            known_revoked_certs_len = len(sets["knownRevoked"])
+            issuer = result["issuer"]
+            issuers.append(issuer)
+            for field, value in zip(issuerStatsFields, result["stats"]):
+                issuerColumns[field].append(value)
 
-            stats["knownnotrevoked"] += known_nonrevoked_certs_len
-            stats["knownrevoked"] += known_revoked_certs_len
-            stats["Issuers"][issuer]["knownnotrevoked"] = known_nonrevoked_certs_len
-            stats["Issuers"][issuer]["knownrevoked"] = known_revoked_certs_len
+            known_nonrevoked_certs_len = issuerColumns["knownnotrevoked"][-1]
+            known_revoked_certs_len = issuerColumns["knownrevoked"][-1]
 
-            crlite.writeCertListForIssuer(
-                file=revfile, issuer_base64=issuer, serial_list=sets["knownRevoked"]
-            )
-            crlite.writeCertListForIssuer(
-                file=nonrevfile,
-                issuer_base64=issuer,
-                serial_list=sets["knownNotRevoked"],
-            )
+            appendAndRemove(revfile, result["knownRevokedPath"])
+            appendAndRemove(nonrevfile, result["knownNotRevokedPath"])
 
             log.debug(
-                f"createCertLists issuerObj={issuerObj} KNR={known_nonrevoked_certs_len} "
+                f"createCertLists issuer={issuer} KNR={known_nonrevoked_certs_len} "
                 + f"KR={known_revoked_certs_len}"
             )
 
@@ -139,6 +223,16 @@ def createCertLists(
                 "CreateCertLists.KnownNotRevoked", count=known_nonrevoked_certs_len
             )
 
+    stats["knownrevoked"] = sum(issuerColumns["knownrevoked"])
+    stats["knownnotrevoked"] = sum(issuerColumns["knownnotrevoked"])
+    stats["revoked"] = sum(issuerColumns["revoked"])
+    stats["known"] = sum(issuerColumns["known"])
+    stats["nocrl"] = issuerColumns["crl"].count(False)
+    stats["Issuers"] = {
+        issuer: dict(zip(issuerStatsFields, values))
+        for issuer, *values in zip(issuers, *issuerColumns.values())
+    }
+
     # TODO: Verify any revoked issuers that had no known issuers
 
     log.debug(
@@ -186,12 +280,50 @@ def generateMLBF(args, stats, *, revoked_certs, nonrevoked_certs, nonrevoked_cer
     return cascade
 
 
+def partitionByCascade(cascade, entries):
+    # Equivalent to splitting `entries` on `entry in cascade`, but probes the
+    # whole batch against one layer before moving on to the next, so a single
+    # layer's bitmap stays in cache instead of every entry walking all layers.
+    contained = []
+    not_contained = []
+    remaining = entries
+    for layer, bloomer in enumerate(cascade.filters, start=1):
+        hits = []
+        for entry in remaining:
+            if entry in bloomer:
+                hits.append(entry)
+            elif layer % 2 == 0:
+                contained.append(entry)
+            else:
+                not_contained.append(entry)
+        remaining = hits
+
+    # Entries present in every layer belong to the deepest layer's side.
+    if len(cascade.filters) % 2 == 1:
+        contained.extend(remaining)
+    else:
+        not_contained.extend(remaining)
+
+    if cascade.invertedLogic is True:
+        return not_contained, contained
+    return contained, not_contained
+
+
 @metrics.timer("VerifyMLBF")
-def verifyMLBF(args, cascade, *, revoked_certs, nonrevoked_certs):
+def verifyMLBF(args, cascade, *, revoked_certs, nonrevoked_certs, batch_size=100_000):
     # Verify generate filter
     if args.noVerify is False:
         log.info("Checking/verifying certs against MLBF")
-        cascade.verify(include=revoked_certs, exclude=nonrevoked_certs)
+        for batch in crlite.batched(revoked_certs, batch_size):
+            _, false_negatives = partitionByCascade(cascade, batch)
+            assert (
+                not false_negatives
+            ), f"Verification Failure: false negative: {false_negatives[0]}"
+        for batch in crlite.batched(nonrevoked_certs, batch_size):
+            false_positives, _ = partitionByCascade(cascade, batch)
+            assert (
+                not false_positives
+            ), f"Verification Failure: false positive: {false_positives[0]}"
 
 
 @metrics.timer("SaveMLBF")
@@ -299,6 +431,13 @@ def parseArgs(argv):
         action="store_true",
     )
     parser.add_argument("-noVerify", help="Skip MLBF verification", action="store_true")
+    parser.add_argument(
+        "-workers",
+        type=int,
+        default=1,
+        help="Number of processes used to build the cert lists. Each one holds an "
+        + "issuer's serial sets, so peak memory grows with this. Default=1",
+    )
     args = parser.parse_args(argv)
     args.outFile = args.certPath / args.id / args.outDirName / "filter"
     if args.knownPath is None:
@@ -338,6 +477,7 @@ def main():
             known_nonrevoked_path=args.validKeys,
             exclude_issuer=args.excludeIssuer,
             stats=stats,
+            workers=args.workers,
         )
         known_nonrevoked_certs_len = results["known_nonrevoked_certs_len"]
 
@@ -350,8 +490,10 @@ def main():
         else:
             try:
                 log.info("Diff: Making diff for known revoked entries")
-                with open(prior_revoked_path, "rb") as prior_fp, open(
-                    args.revokedKeys, "rb"
+                with open(
+                    prior_revoked_path, "rb", buffering=crlite.file_buffer_size
+                ) as prior_fp, open(
+                    args.revokedKeys, "rb", buffering=crlite.file_buffer_size
                 ) as fp:
                     revoked_diff_by_issuer = find_additions(
                         old_by_issuer=crlite.readFromCertListByIssuer(prior_fp),
@@ -380,12 +522,12 @@ def main():
         log.info("known_nonrevoked_certs_len not calculated, calculating...")
         with metrics.timer("CalculateKnownNonrevokedCertsLen"):
             with open(args.validKeys, "rb") as fp:
-                known_nonrevoked_certs_len = len(list(crlite.readFromCertList(fp)))
+                known_nonrevoked_certs_len = crlite.countCertList(fp)
 
     log.info("revoked_certs loading...")
     with metrics.timer("LoadRevokedCerts"):
         with open(args.revokedKeys, "rb") as fp:
-            revoked_certs = set(crlite.readFromCertList(fp))
+            revoked_certs = set(crlite.readKeysFromCertList(fp))
     num_revoked_certs = len(revoked_certs)
 
     log.info(
@@ -396,28 +538,32 @@ def main():
     if num_revoked_certs == 0:
         sys.exit(1)
 
+    # The nonrevoked list is larger than memory, so it is streamed from disk.
+    # FilterCascade.initialize reads it once, for the first layer only (later
+    # layers exclude the previous layer's include set), and verifyMLBF reads it
+    # a second time; CertListKeys re-opens the file for each of those passes.
+    nonrevoked_certs = crlite.CertListKeys(args.validKeys)
+
     # Generate new filter
     log.info("Constructing MLBF")
-    with open(args.validKeys, "rb") as fp:
-        mlbf = generateMLBF(
-            args,
-            stats,
-            revoked_certs=revoked_certs,
-            nonrevoked_certs=crlite.readFromCertList(fp),
-            nonrevoked_certs_len=known_nonrevoked_certs_len,
-        )
+    mlbf = generateMLBF(
+        args,
+        stats,
+        revoked_certs=revoked_certs,
+        nonrevoked_certs=nonrevoked_certs,
+        nonrevoked_certs_len=known_nonrevoked_certs_len,
+    )
 
     log.info(f"MLBF complete. memory={psutil.virtual_memory()}")
 
     if mlbf.bitCount() > 0:
         log.info(f"Validating MLBF. Bit-count={mlbf.bitCount()}")
-        with open(args.validKeys, "rb") as fp:
-            verifyMLBF(
-                args,
-                mlbf,
-                revoked_certs=revoked_certs,
-                nonrevoked_certs=crlite.readFromCertList(fp),
-            )
+        verifyMLBF(
+            args,
+            mlbf,
+            revoked_certs=revoked_certs,
+            nonrevoked_certs=nonrevoked_certs,
+        )
 
         log.info(f"MLBF validation complete. memory={psutil.virtual_memory()}")
 
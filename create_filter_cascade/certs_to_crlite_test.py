@@ -1,8 +1,16 @@
+import argparse
 import base64
+import tempfile
+import threading
+import time
 import unittest
 import moz_crlite_lib as crlite
 
+from concurrent.futures import ThreadPoolExecutor
 from create_filter_cascade import certs_to_crlite
+from filtercascade import FilterCascade
+from pathlib import Path
+from unittest import mock
 
 
 class MockFile(object):
@@ -115,5 +123,245 @@ class TestCertListDiff(unittest.TestCase):
         self.assertEqual(len(diff), 0)
 
 
+class TestCreateCertLists(unittest.TestCase):
+    def test_create_cert_lists(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            known_path = tmpdirname / Path("known")
+            revoked_path = tmpdirname / Path("revoked")
+            known_path.mkdir()
+            revoked_path.mkdir()
+
+            (known_path / "aG9uZXN0Q0EK").write_text("00AA\nAA00\nAAAAAA\n")
+            (revoked_path / "aG9uZXN0Q0EK").write_text("AA00\n000000\n")
+            (known_path / "b3RoZXJDQQo=").write_text("FFCCDD\n")
+
+            stats = {}
+            results = certs_to_crlite.createCertLists(
+                known_path=known_path,
+                revoked_path=revoked_path,
+                known_revoked_path=tmpdirname / Path("mlbf/list-revoked.keys"),
+                known_nonrevoked_path=tmpdirname / Path("mlbf/list-valid.keys"),
+                exclude_issuer=[],
+                stats=stats,
+                workers=2,
+            )
+
+            self.assertEqual(results["known_revoked_certs_len"], 1)
+            self.assertEqual(results["known_nonrevoked_certs_len"], 3)
+            self.assertEqual(stats["known"], 4)
+            self.assertEqual(stats["revoked"], 2)
+            self.assertEqual(stats["nocrl"], 1)
+            self.assertEqual(
+                stats["Issuers"]["aG9uZXN0Q0EK"],
+                {
+                    "known": 3,
+                    "revoked": 2,
+                    "knownnotrevoked": 2,
+                    "knownrevoked": 1,
+                    "crl": True,
+                },
+            )
+            self.assertFalse(stats["Issuers"]["b3RoZXJDQQo="]["crl"])
+
+            with open(tmpdirname / Path("mlbf/list-revoked.keys"), "rb") as fp:
+                revoked = dict(crlite.readFromCertListByIssuer(fp))
+            with open(tmpdirname / Path("mlbf/list-valid.keys"), "rb") as fp:
+                nonrevoked = dict(crlite.readFromCertListByIssuer(fp))
+
+            self.assertEqual(
+                revoked, {b"aG9uZXN0Q0EK": {make_certid("aG9uZXN0Q0EK", "AA00")}}
+            )
+            self.assertEqual(
+                nonrevoked,
+                {
+                    b"aG9uZXN0Q0EK": {
+                        make_certid("aG9uZXN0Q0EK", "00AA"),
+                        make_certid("aG9uZXN0Q0EK", "AAAAAA"),
+                    },
+                    b"b3RoZXJDQQo=": {make_certid("b3RoZXJDQQo=", "FFCCDD")},
+                },
+            )
+
+    def test_create_cert_lists_largest_first(self):
+        # Issuer sizes run opposite to issuer order, so the first issuer to be
+        # written is the last one submitted to the pool.
+        issuers = sorted(
+            base64.urlsafe_b64encode(b"issuer%d" % i).decode() for i in range(6)
+        )
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            known_path = tmpdirname / Path("known")
+            revoked_path = tmpdirname / Path("revoked")
+            out_path = tmpdirname / Path("mlbf")
+            known_path.mkdir()
+            revoked_path.mkdir()
+
+            for idx, issuer in enumerate(issuers):
+                serials = ["%06X" % s for s in range(100 * (idx + 1))]
+                (known_path / issuer).write_text("\n".join(serials) + "\n")
+                (revoked_path / issuer).write_text(serials[0] + "\n")
+
+            stats = {}
+            certs_to_crlite.createCertLists(
+                known_path=known_path,
+                revoked_path=revoked_path,
+                known_revoked_path=out_path / "list-revoked.keys",
+                known_nonrevoked_path=out_path / "list-valid.keys",
+                exclude_issuer=[],
+                stats=stats,
+                workers=2,
+            )
+
+            with open(out_path / "list-valid.keys", "rb") as fp:
+                written = [
+                    (issuer.decode(), len(certIds))
+                    for issuer, certIds in crlite.readFromCertListByIssuer(fp)
+                ]
+            self.assertEqual(
+                written,
+                [(issuer, 100 * (idx + 1) - 1) for idx, issuer in enumerate(issuers)],
+            )
+
+            # The per-issuer scratch files are consumed as they're written
+            self.assertEqual(
+                sorted(p.name for p in out_path.iterdir()),
+                ["list-revoked.keys", "list-valid.keys"],
+            )
+
+    def test_issuers_in_flight_fit_within_the_largest(self):
+        sizes = [5, 40, 10, 100, 60, 10, 50]
+        issuerObjs = [
+            crlite.IssuerDataOnDisk(
+                issuer=f"issuer{idx}", knownPath=None, revokedPath=None, knownSize=size
+            )
+            for idx, size in enumerate(sizes)
+        ]
+        lock = threading.Lock()
+        inFlight = []
+        peaks = []
+
+        def fakeProcessIssuer(issuerObj, scratch_dir):
+            with lock:
+                inFlight.append(issuerObj.knownSize)
+                peaks.append(list(inFlight))
+            time.sleep(0.01)
+            with lock:
+                inFlight.remove(issuerObj.knownSize)
+            return {"issuer": issuerObj.issuer}
+
+        with mock.patch.object(
+            certs_to_crlite, "processIssuer", fakeProcessIssuer
+        ), ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(
+                certs_to_crlite.genProcessedIssuers(
+                    executor, issuerObjs, "scratch", workers=3
+                )
+            )
+
+        self.assertEqual(
+            [result["issuer"] for result in results],
+            [issuerObj.issuer for issuerObj in issuerObjs],
+        )
+        # The largest issuer ran first and alone, the small ones shared
+        self.assertEqual(peaks[0], [100])
+        self.assertLessEqual(max(sum(peak) for peak in peaks), 100)
+        self.assertGreater(max(len(peak) for peak in peaks), 1)
+
+    def test_failing_issuer_stops_submission(self):
+        issuerObjs = [
+            crlite.IssuerDataOnDisk(
+                issuer=f"issuer{idx}", knownPath=None, revokedPath=None, knownSize=1
+            )
+            for idx in range(20)
+        ]
+        submitted = []
+
+        def fakeProcessIssuer(issuerObj, scratch_dir):
+            submitted.append(issuerObj.issuer)
+            raise RuntimeError(issuerObj.issuer)
+
+        with mock.patch.object(
+            certs_to_crlite, "processIssuer", fakeProcessIssuer
+        ), ThreadPoolExecutor(max_workers=2) as executor:
+            with self.assertRaises(RuntimeError):
+                list(
+                    certs_to_crlite.genProcessedIssuers(
+                        executor, issuerObjs, "scratch", workers=2
+                    )
+                )
+
+        self.assertLessEqual(len(submitted), 2)
+
+    def test_process_issuer_returns_no_serial_data(self):
+        issuer = "aG9uZXN0Q0EK"
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            known = tmpdirname / Path("known")
+            known.write_text("00AA\nAA00\n")
+            issuerObj = crlite.IssuerDataOnDisk(
+                issuer=issuer, knownPath=known, revokedPath=None
+            )
+
+            result = certs_to_crlite.processIssuer(issuerObj, tmpdirname)
+
+            self.assertEqual(
+                set(result),
+                {"issuer", "stats", "knownRevokedPath", "knownNotRevokedPath"},
+            )
+            with open(result["knownNotRevokedPath"], "rb") as fp:
+                self.assertEqual(
+                    dict(crlite.readFromCertListByIssuer(fp)),
+                    {
+                        issuer.encode(): {
+                            make_certid(issuer, "00AA"),
+                            make_certid(issuer, "AA00"),
+                        }
+                    },
+                )
+
+
+class TestVerifyMLBF(unittest.TestCase):
+    def test_partition_matches_contains(self):
+        revoked = {b"revoked-%d" % i for i in range(100)}
+        nonrevoked = {b"valid-%d" % i for i in range(5000)}
+
+        for include, exclude in [(revoked, nonrevoked), (nonrevoked, revoked)]:
+            cascade = FilterCascade([], min_filter_length=8)
+            cascade.initialize(include=include, exclude=exclude)
+            self.assertGreater(cascade.layerCount(), 1)
+
+            entries = list(include | exclude)
+            contained, not_contained = certs_to_crlite.partitionByCascade(
+                cascade, entries
+            )
+            self.assertEqual(set(contained), {e for e in entries if e in cascade})
+            self.assertEqual(set(contained), include)
+            self.assertEqual(set(not_contained), exclude)
+
+    def test_verify_batches(self):
+        revoked = {b"revoked-%d" % i for i in range(100)}
+        nonrevoked = {b"valid-%d" % i for i in range(5000)}
+        cascade = FilterCascade([], min_filter_length=8)
+        cascade.initialize(include=revoked, exclude=nonrevoked)
+
+        args = argparse.Namespace(noVerify=False)
+        certs_to_crlite.verifyMLBF(
+            args,
+            cascade,
+            revoked_certs=revoked,
+            nonrevoked_certs=nonrevoked,
+            batch_size=64,
+        )
+
+        with self.assertRaises(AssertionError):
+            certs_to_crlite.verifyMLBF(
+                args,
+                cascade,
+                revoked_certs=revoked,
+                nonrevoked_certs=revoked,
+                batch_size=64,
+            )
+
+
 if __name__ == "__main__":
     unittest.main()
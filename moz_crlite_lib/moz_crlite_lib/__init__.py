@@ -5,7 +5,9 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import base64
+import itertools
 import logging
+import mmap
 import os
 import struct
 
@@ -29,6 +31,14 @@ serials_struct = struct.Struct(b"<B")
 # then N serials_structs followed by M serials_structs
 additions_struct = struct.Struct(b"<LB")
 
+# Buffer size for the large, sequentially read and written serial files;
+# the 8 KiB default costs a syscall for every few hundred serials.
+file_buffer_size = 4 * 1024 * 1024
+
+# Serials joined into each write() by writeSerialBytes, which bounds the
+# temporary buffers for the largest issuers.
+serials_per_write = 1_000_000
+
 issuerCache = {}
 
 
@@ -87,40 +97,64 @@ class CertId(object):
 
 
 class IssuerDataOnDisk(object):
-    def __init__(self, *, issuer, knownPath, revokedPath):
+    def __init__(self, *, issuer, knownPath, revokedPath, knownSize=0):
         self.issuer = issuer
         self.knownPath = knownPath
         self.revokedPath = revokedPath
+        self.knownSize = knownSize
 
     def __repr__(self):
         return f"{self.issuer}"
 
-    def load_and_make_sets(self, stats):
+    def load_and_make_sets(self, issuerStats):
+        # Fills in this issuer's "known", "revoked" and "crl" entries of
+        # issuerStats; totals across issuers are left to the caller.
         knownSet = getCertList(self.knownPath, self.issuer)
-        if knownSet:
-            stats["known"] += len(knownSet)
-        else:
+        if not knownSet:
             knownSet = set()
-        stats["Issuers"][self.issuer]["known"] = len(knownSet)
+        issuerStats["known"] = len(knownSet)
 
-        revSet = getCertList(self.revokedPath, self.issuer)
+        revSet = None
+        if self.revokedPath is not None:
+            revSet = getCertList(self.revokedPath, self.issuer)
         if revSet:
-            stats["revoked"] += len(revSet)
-            stats["Issuers"][self.issuer]["crl"] = True
+            issuerStats["crl"] = True
         else:
-            stats["nocrl"] += 1
             revSet = set()
-        stats["Issuers"][self.issuer]["revoked"] = len(revSet)
-
-        knownNotRevoked = knownSet - revSet
-        knownRevoked = knownSet & revSet
+        issuerStats["revoked"] = len(revSet)
+
+        # Issuers without a CRL (or without known certs) need no set work.
+        # Otherwise revSet is usually orders of magnitude smaller than
+        # knownSet. Set intersection probes from the smaller operand, and
+        # knownSet isn't needed afterwards, so the revoked entries are
+        # discarded from it in place rather than copying it into a new
+        # difference set.
+        knownRevoked = set()
+        if revSet and knownSet:
+            knownRevoked = revSet & knownSet
+            knownSet -= knownRevoked
         return {
             "issuer": self.issuer,
-            "knownNotRevoked": knownNotRevoked,
+            "knownNotRevoked": knownSet,
             "knownRevoked": knownRevoked,
         }
 
 
+class CertListKeys(object):
+    # Re-iterable view of the keys in a cert list file. Every pass re-opens
+    # and re-maps the file, so nothing but the page cache is held between
+    # passes.
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, "rb") as file:
+            yield from readKeysFromCertList(file)
+
+    def __repr__(self):
+        return f"CertListKeys({self.path})"
+
+
 def getIssuerIdFromCache(issuerSpkiHash):
     if not isinstance(issuerSpkiHash, bytes):
         raise Exception("issuerSpkiHash must be bytes")
@@ -132,23 +166,30 @@ def getIssuerIdFromCache(issuerSpkiHash):
 
 
 def getCertList(certpath_str, issuer):
-    issuerId = getIssuerIdFromCache(base64.urlsafe_b64decode(issuer))
-
     certpath = Path(certpath_str)
 
     certlist = set()
-    if not certpath.is_file():
+    try:
+        f = open(certpath, "r", buffering=file_buffer_size)
+    except FileNotFoundError:
         log.error(f"getCertList couldn't find file {certpath}")
         return None
 
-    log.debug(f"getCertList opening {certpath} (sz={certpath.stat().st_size})")
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        log.debug(f"getCertList opening {certpath} (sz={size})")
 
-    with open(certpath, "r") as f:
         try:
+            # Decode the whole file in one C-level pass; only if some line is
+            # malformed, rewind and take the per-line path that reports it.
+            try:
+                return set(map(bytes.fromhex, f))
+            except ValueError:
+                f.seek(0)
+
             for cnt, sHex in enumerate(f):
                 try:
-                    serial = bytes.fromhex(sHex)
-                    certlist.add(CertId(issuerId, serial))
+                    certlist.add(bytes.fromhex(sHex))
                 except ValueError as te:
                     log.error(
                         f"Couldn't decode line={cnt} issuer={issuer} serial "
@@ -162,31 +203,66 @@ def getCertList(certpath_str, issuer):
 
 
 def genIssuerPathObjects(*, knownPath, revokedPath, excludeIssuer):
-    for path, dirs, files in os.walk(knownPath):
-        for filename in files:
-            issuer = os.path.splitext(filename)[0]
+    # List the revoked directory once up front rather than probing it for
+    # every known issuer; issuers without a CRL get a revokedPath of None.
+    revokedIssuers = set()
+    if os.path.isdir(revokedPath):
+        revokedIssuers = set(os.listdir(revokedPath))
+
+    if not os.path.isdir(knownPath):
+        return
+
+    # The known directory is flat, so scandir is enough, and its entries
+    # carry the file type from the listing. entry.stat() still costs one
+    # stat() per file on Linux (only d_type is cached), which the
+    # largest-first scheduling in createCertLists needs for the size.
+    with os.scandir(knownPath) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+
+            issuer = os.path.splitext(entry.name)[0]
             if issuer in excludeIssuer:
                 continue
 
+            issuerRevokedPath = None
+            if issuer in revokedIssuers:
+                issuerRevokedPath = revokedPath / Path(issuer)
+
             yield IssuerDataOnDisk(
                 issuer=issuer,
-                knownPath=path / Path(filename),
-                revokedPath=revokedPath / Path(issuer),
+                knownPath=Path(entry.path),
+                revokedPath=issuerRevokedPath,
+                knownSize=entry.stat().st_size,
             )
 
 
-def writeSerials(file, serial_list):
-    for k in serial_list:
-        n = len(k.serial)
-        if n > 0xFF:
-            raise ValueError("serial bytes > unsigned short")
-        file.write(serials_struct.pack(n))
-        file.write(k.serial)
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
 
-def writeCertListForIssuer(*, file, issuer_base64, serial_list):
-    num_serial_list = len(serial_list)
+def writeSerialBytes(file, serials):
+    for chunk in batched(serials, serials_per_write):
+        records = []
+        for serial in chunk:
+            n = len(serial)
+            if n > 0xFF:
+                raise ValueError("serial bytes > unsigned short")
+            records.append(serials_struct.pack(n))
+            records.append(serial)
+        file.write(b"".join(records))
+
 
+def writeSerials(file, serial_list):
+    writeSerialBytes(file, (k.serial for k in serial_list))
+
+
+def writeIssuerHeader(file, issuer_base64, num_serial_list):
     issuer = base64.urlsafe_b64decode(issuer_base64)
     issuer_len = len(issuer)
 
@@ -198,11 +274,19 @@ def writeCertListForIssuer(*, file, issuer_base64, serial_list):
     file.write(issuers_struct.pack(num_serial_list, issuer_len))
     file.write(issuer)
 
+
+def writeCertListForIssuer(*, file, issuer_base64, serial_list):
+    writeIssuerHeader(file, issuer_base64, len(serial_list))
     writeSerials(file, serial_list)
 
 
+def writeSerialListForIssuer(*, file, issuer_base64, serials):
+    writeIssuerHeader(file, issuer_base64, len(serials))
+    writeSerialBytes(file, serials)
+
+
 def save_additions(*, out_path, revoked_by_issuer):
-    with open(out_path, "wb") as file:
+    with open(out_path, "wb", buffering=file_buffer_size) as file:
         for issuer_b64, issuer_revocations in revoked_by_issuer.items():
             issuer = base64.urlsafe_b64decode(issuer_b64)
             issuer_len = len(issuer)
@@ -220,15 +304,21 @@ def save_additions(*, out_path, revoked_by_issuer):
 
 
 def expectRead(file, expectedBytes):
-    data = []
-    remaining = expectedBytes
-    while remaining > 0:
-        result = file.read(remaining)
-        if len(result) == 0:
-            raise EOFException()
-        remaining -= len(result)
-        data.extend(result)
-    return result
+    result = file.read(expectedBytes)
+    if len(result) == expectedBytes:
+        return result
+
+    # Short read: fill a buffer allocated once at its final size rather than
+    # growing one chunk at a time.
+    data = bytearray(expectedBytes)
+    offset = 0
+    while len(result) > 0:
+        data[offset : offset + len(result)] = result
+        offset += len(result)
+        if offset == expectedBytes:
+            return bytes(data)
+        result = file.read(expectedBytes - offset)
+    raise EOFException()
 
 
 def readFromAdditionsList(file):
@@ -292,6 +382,67 @@ def readFromCertList(file):
         return
 
 
+def mapCertList(file):
+    # `file` must be a real file opened in binary mode. Returns None for empty
+    # files, which can't be mapped and contain no records anyway.
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return None
+
+
+def genSerialSpansFromCertListMap(buf, name):
+    # Walks a mapped cert list by offset, so there is no read() call per
+    # field, yielding (issuer bytes, start, end) for every serial; the serial
+    # itself is buf[start:end]. Truncated trailing records are dropped.
+    end = len(buf)
+    offset = 0
+    while offset + issuers_struct.size <= end:
+        (num_serial_list, issuer_len) = issuers_struct.unpack_from(buf, offset)
+        offset += issuers_struct.size
+        assert issuer_len <= 64, (
+            f"issuer spki hash should be 64 bytes, got {issuer_len} "
+            + f"at offset {offset} of {name}"
+        )
+        issuer_bytes = buf[offset : offset + issuer_len]
+        offset += issuer_len
+
+        for serial_idx in range(num_serial_list):
+            if offset + serials_struct.size > end:
+                return
+            (serial_len,) = serials_struct.unpack_from(buf, offset)
+            offset += serials_struct.size
+            assert serial_len <= 64, (
+                f"serial length should be small, got {serial_len} "
+                + f"at offset {offset} of {name}"
+            )
+            if offset + serial_len > end:
+                return
+            yield (issuer_bytes, offset, offset + serial_len)
+            offset += serial_len
+
+
+def readKeysFromCertList(file):
+    # Yields the same bytes as CertId.to_bytes(), which is what the filter
+    # cascade hashes, without building an IssuerId/CertId per entry.
+    buf = mapCertList(file)
+    if buf is None:
+        return
+
+    with buf:
+        for issuer_bytes, start, end in genSerialSpansFromCertListMap(buf, file.name):
+            yield issuer_bytes + buf[start:end]
+
+
+def countCertList(file):
+    buf = mapCertList(file)
+    if buf is None:
+        return 0
+
+    with buf:
+        return sum(1 for _ in genSerialSpansFromCertListMap(buf, file.name))
+
+
 def readFromCertListByIssuer(file):
     current_certIds = None
     current_issuer = None
@@ -1,6 +1,7 @@
 import base64
 import tempfile
 import unittest
+import unittest.mock
 import moz_crlite_lib as crlite
 
 from pathlib import Path
@@ -64,6 +65,26 @@ class TestStructs(unittest.TestCase):
         crlite.writeSerials(f, [make_certid(b"YQo=", "FF" * 255)])
         self.assertEqual(len(f), 256)
 
+    def test_batched(self):
+        self.assertEqual(
+            list(crlite.batched(range(10), 4)), [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+        )
+        self.assertEqual(list(crlite.batched([], 4)), [])
+
+    def test_write_serials_in_chunks(self):
+        f = MockFile()
+        serials = [bytes([i]) for i in range(10)]
+
+        with unittest.mock.patch.object(crlite, "serials_per_write", 4):
+            with self.assertRaises(ValueError):
+                crlite.writeSerialBytes(f, serials[:5] + [b"\xff" * 256])
+            # Only the first chunk, validated before the bad one, was written
+            self.assertEqual(len(f), 8)
+
+            f = MockFile()
+            crlite.writeSerialBytes(f, serials)
+        self.assertEqual(f.data, b"".join(b"\x01" + s for s in serials))
+
     def test_write_issuer(self):
         f = MockFile()
 
@@ -95,6 +116,35 @@ class TestStructs(unittest.TestCase):
         )
         self.assertEqual(len(f), 69)
 
+    def test_write_serial_list_for_issuer(self):
+        f = MockFile()
+
+        issuer_base64 = base64.standard_b64encode(b"FF" * 0x20)
+        crlite.writeSerialListForIssuer(
+            file=f, issuer_base64=issuer_base64, serials={bytes.fromhex("CABF00D0")}
+        )
+        self.assertEqual(len(f), 74)
+
+        loaded = dict(crlite.readFromCertListByIssuer(f))
+        self.assertEqual(
+            loaded[issuer_base64], set([make_certid(issuer_base64, "CABF00D0")])
+        )
+
+
+class TestExpectRead(unittest.TestCase):
+    def test_short_reads(self):
+        class TrickleFile(MockFile):
+            def read(self, count=0xFFFFFFFF):
+                return super().read(min(count, 3))
+
+        f = TrickleFile()
+        f.write(b"0123456789")
+
+        self.assertEqual(crlite.expectRead(f, 0), b"")
+        self.assertEqual(crlite.expectRead(f, 8), b"01234567")
+        with self.assertRaises(crlite.EOFException):
+            crlite.expectRead(f, 8)
+
 
 class TestCertLists(unittest.TestCase):
     def assertCertListEqual(self, a, b):
@@ -137,6 +187,54 @@ class TestCertLists(unittest.TestCase):
             self.assertCertListEqual(loaded_revoked, revoked)
             self.assertCertListEqual(loaded_nonrevoked, nonrevoked)
 
+            with open(nonrevoked_path, "rb") as file:
+                self.assertEqual(crlite.countCertList(file), 3)
+
+            with open(revoked_path, "rb") as file:
+                self.assertEqual(
+                    set(crlite.readKeysFromCertList(file)),
+                    {
+                        certId.to_bytes()
+                        for serials in revoked.values()
+                        for certId in serials
+                    },
+                )
+
+    def test_get_cert_list(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            path = tmpdirname / Path("aG9uZXN0Q0EK")
+            path.write_text("00AA\nAA00\nnot hex\n")
+
+            certs = crlite.getCertList(path, "aG9uZXN0Q0EK")
+            self.assertEqual(certs, {bytes.fromhex("00AA"), bytes.fromhex("AA00")})
+
+            self.assertIsNone(
+                crlite.getCertList(tmpdirname / Path("missing"), "aG9uZXN0Q0EK")
+            )
+
+    def test_cert_list_keys_reiterable(self):
+        revoked, _ = static_test_certs()
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            revoked_path = tmpdirname / Path("revoked.bin")
+            with open(revoked_path, "wb") as revfile:
+                for issuer, serials in revoked.items():
+                    crlite.writeCertListForIssuer(
+                        file=revfile, issuer_base64=issuer, serial_list=serials
+                    )
+
+            keys = crlite.CertListKeys(revoked_path)
+            self.assertEqual(len(list(keys)), 3)
+            self.assertEqual(list(keys), list(keys))
+
+    def test_read_keys_from_empty_cert_list(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            path = tmpdirname / Path("empty.keys")
+            path.write_bytes(b"")
+
+            with open(path, "rb") as file:
+                self.assertEqual(list(crlite.readKeysFromCertList(file)), [])
+
     def test_save_diff_file(self):
         revoked, _ = static_test_certs()
 
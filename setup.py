@@ -5,7 +5,6 @@ setup(
     version="1.0.3",
     packages=["create_filter_cascade", "moz_kinto_publisher", "workflow"],
     install_requires=[
-        "bsdiff4>=1.1",
         "cryptography>=2.2",
         "Deprecated>=1.2",
         "filtercascade>=0.3.1",